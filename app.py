@@ -1,92 +1,289 @@
-import io, json, os
+import glob, hashlib, io, os, threading
+from collections import OrderedDict
 import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 import plotly.express as px
+import plotly.graph_objects as go
 import gradio as gr
+from gradio.components.plot import PlotData
 
 # Config
 DATAFILE = os.getenv("DEFAULT_DATAFILE", "customer_acquisition_data.csv")
 REQUIRED_COLS = ["customer_id", "channel", "cost", "conversion_rate", "revenue"]
+# customer_id is only counted, so it keeps pyarrow's inferred type (IDs may be strings)
+CSV_TYPES = {
+    "channel": pa.dictionary(pa.int32(), pa.string()),
+    # float64 keeps user input and the money totals exact in the summary and downloads
+    "cost": pa.float64(),
+    "conversion_rate": pa.float64(),
+    "revenue": pa.float64(),
+}
+QUEUE_CONCURRENCY = 8
+QUEUE_MAX_SIZE = 32
+CACHE_SIZE = 8
+DOWNLOAD_KEEP = 8  # generated CSVs kept per kind in /tmp, newest first
+FIG_CACHE_SIZE = 64
+HASH_CHUNK = 1024 * 1024
 
 def _ensure_cols(df: pd.DataFrame):
     missing = [c for c in REQUIRED_COLS if c not in df.columns]
     if missing:
         raise ValueError(f"Missing columns: {missing}\nExpected: {REQUIRED_COLS}")
 
+def _read_csv(path):
+    # Multi-threaded Arrow parser with a fixed schema; channel arrives dictionary-encoded
+    # (pandas Categorical). Columns absent from the file are ignored here and reported by
+    # _ensure_cols. Blank/NA strings are nulls, as with pd.read_csv.
+    opts = pv.ConvertOptions(column_types=CSV_TYPES, strings_can_be_null=True)
+    return pv.read_csv(path, convert_options=opts).to_pandas()
+
 def _compute_metrics(df: pd.DataFrame):
     _ensure_cols(df)
-    df = df.copy()
-    df["roi"]  = df["revenue"] / df["cost"]
-    df["cltv"] = ((df["revenue"] - df["cost"]) * df["conversion_rate"]) / df["cost"]
-
-    by_channel = (
-        df.groupby("channel")
-          .agg(
-              customers=("customer_id","count"),
-              avg_cost=("cost","mean"),
-              avg_conv_rate=("conversion_rate","mean"),
-              total_revenue=("revenue","sum"),
-              avg_roi=("roi","mean"),
-              avg_cltv=("cltv","mean"),
-          )
-          .sort_values("avg_cltv", ascending=False)
-          .reset_index()
-    )
-    by_channel["revenue_share_%"] = (
-        100 * by_channel["total_revenue"] / by_channel["total_revenue"].sum()
-    )
+    # One reciprocal of cost shared by both metrics; in-place ops avoid temporaries
+    cost = df["cost"].to_numpy(dtype=np.float64)
+    rev  = df["revenue"].to_numpy(dtype=np.float64)
+    inv  = np.reciprocal(cost)
+    roi  = rev * inv
+    cltv = np.subtract(rev, cost)
+    cltv *= df["conversion_rate"].to_numpy()
+    cltv *= inv
+    # Callers pass a freshly parsed frame, so new columns are attached in place
+    df["roi"], df["cltv"] = roi, cltv
+    df["channel"] = df["channel"].astype("category")
+
+    # All reductions share the categorical codes as one factorization; bincount sums in float64.
+    # Bucket 0 holds rows with a missing channel (code -1): the per-channel summary drops
+    # them, as groupby does, while the overall means still include them, as Series.mean does.
+    buckets = df["channel"].cat.codes.to_numpy().astype(np.intp) + 1
+    nb = len(df["channel"].cat.categories) + 1
+    bucket_rows = np.bincount(buckets, minlength=nb)
+    seen = bucket_rows[1:] > 0
+
+    def _bsum(col):
+        # NaN-skipping (sum, count) per bucket, matching pandas sum/mean
+        vals = df[col].to_numpy()
+        nan = np.isnan(vals)
+        if not nan.any():
+            return np.bincount(buckets, weights=vals, minlength=nb), bucket_rows
+        ok = ~nan
+        return (np.bincount(buckets[ok], weights=vals[ok], minlength=nb),
+                np.bincount(buckets[ok], minlength=nb))
+
+    def _per_channel(bsum): return bsum[0][1:][seen], bsum[1][1:][seen]
+
+    def _gsum(col): return _per_channel(_bsum(col))
+
+    def _mean(total, count):
+        with np.errstate(invalid="ignore", divide="ignore"):  # all-NaN channel -> NaN
+            return total / count
+
+    def _overall_mean(total, count):
+        n_valid = count.sum()
+        return float(total.sum() / n_valid) if n_valid else float("nan")
+
+    customers = np.bincount(buckets, weights=df["customer_id"].notna().to_numpy(),
+                            minlength=nb)[1:][seen].astype(np.int64)
+    roi_bsum, cltv_bsum = _bsum("roi"), _bsum("cltv")
+    avg_roi, avg_cltv = _mean(*_per_channel(roi_bsum)), _mean(*_per_channel(cltv_bsum))
+    # Order by avg CLTV on the arrays so the summary frame is built once, already sorted
+    order = np.argsort(-avg_cltv, kind="stable")
+    by_channel = pd.DataFrame({
+        "channel": df["channel"].cat.categories[seen][order],
+        "customers": customers[order],
+        "avg_cost": _mean(*_gsum("cost"))[order],
+        "avg_conv_rate": _mean(*_gsum("conversion_rate"))[order],
+        "total_revenue": _gsum("revenue")[0][order],
+        "avg_roi": avg_roi[order],
+        "avg_cltv": avg_cltv[order],
+    })
+    tr = by_channel["total_revenue"].to_numpy()
+    by_channel["revenue_share_%"] = tr * (100.0 / tr.sum())
+    # Overall stats reuse the bucket sums rather than rescanning the columns
     meta = {
         "rows": int(len(df)),
-        "channels": int(df["channel"].nunique()),
-        "current_weighted_roi": float(df["roi"].mean()),
-        "current_avg_cltv": float(df["cltv"].mean()),
+        "channels": int(len(by_channel)),
+        "current_weighted_roi": _overall_mean(*roi_bsum),
+        "current_avg_cltv": _overall_mean(*cltv_bsum),
+    }
+    # Simulator inputs depend only on the dataset; precompute them once here
+    roi_arr, cltv_arr = by_channel["avg_roi"].to_numpy(), by_channel["avg_cltv"].to_numpy()
+    cur_w = by_channel["revenue_share_%"].to_numpy() / 100.0
+    meta["_sim"] = {
+        "channels": tuple(map(str, by_channel["channel"])),
+        "roi": roi_arr,
+        "cltv": cltv_arr,
+        "cur_roi": float(roi_arr @ cur_w),
+        "cur_cltv": float(cltv_arr @ cur_w),
     }
     return df, by_channel, meta
 
+def _write_csv(frame, path):
+    tbl = pa.Table.from_pandas(pd.DataFrame(frame), preserve_index=False)
+    # Decode dictionary (categorical) columns to plain strings for the CSV writer
+    tbl = tbl.cast(pa.schema([
+        pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f
+        for f in tbl.schema
+    ]))
+    pv.write_csv(tbl, path, write_options=pv.WriteOptions(include_header=True))
+
+def _prune_downloads(prefix):
+    entries = []
+    for path in glob.glob(f"/tmp/{prefix}.*.csv"):
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:  # removed by a concurrent prune
+            pass
+    for _, path in sorted(entries, reverse=True)[DOWNLOAD_KEEP:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# Dataset cache: (df, by_channel, meta) keyed by file identity, shared by queue workers
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _stat_key(path):
+    st = os.stat(path)
+    return ("stat", os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def _content_key(path):
+    # Uploads land at a fresh temp path each time, so key them by a hash of the full
+    # content; hashing is far cheaper than the parse it guards.
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return ("content", h.hexdigest())
+
+def _load_and_compute(path, key):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = _compute_metrics(_read_csv(path))
+    result[2]["_digest"] = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+# The built-in dataset is pinned outside the LRU so uploads never evict it;
+# its stat key (mtime, size) revalidates it on each load.
+_BUILTIN_CACHE = {"key": None, "value": None}
+
 def load_builtin():
     if not os.path.exists(DATAFILE):
         raise gr.Error(
             f"Default dataset '{DATAFILE}' not found in repo root.\n"
             "Upload the CSV to your Space or set env var DEFAULT_DATAFILE."
         )
-    df = pd.read_csv(DATAFILE)
-    return _compute_metrics(df)
+    key = _stat_key(DATAFILE)
+    with _cache_lock:
+        if _BUILTIN_CACHE["key"] == key:
+            return _BUILTIN_CACHE["value"]
+    value = _load_and_compute(DATAFILE, key)
+    with _cache_lock:
+        _BUILTIN_CACHE.update(key=key, value=value)
+    return value
 
 def load_uploaded(file):
     if file is None:
         return load_builtin()
-    df = pd.read_csv(file.name if hasattr(file, "name") else file)
-    return _compute_metrics(df)
+    path = file.name if hasattr(file, "name") else file
+    return _load_and_compute(path, _content_key(path))
 
 # Plots
-def hist(df, col, title): return px.histogram(df, x=col, nbins=20, title=title)
+def hist(df, col, title):
+    # Bin on the server and send 20 counts instead of the raw column
+    arr = df[col].to_numpy()
+    counts, edges = np.histogram(arr[np.isfinite(arr)], bins=20)
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    fig = go.Figure(go.Bar(x=centers, y=counts, width=np.diff(edges)))
+    fig.update_layout(title=title, bargap=0, xaxis_title=col, yaxis_title="count")
+    return fig
 def bar(df, x, y, title): return px.bar(df, x=x, y=y, title=title)
 def pie(df): return px.pie(df, values="total_revenue", names="channel", title="Total Revenue by Channel", hole=0.6)
-def cltv_box(df): return px.box(df, x="channel", y="cltv", title="CLTV Distribution by Channel")
+
+def cltv_box(df):
+    # Box statistics are computed here so only five numbers per channel reach the browser
+    names, stats = [], []
+    for ch, vals in df.groupby("channel", observed=True)["cltv"]:
+        v = vals.to_numpy()
+        v = v[np.isfinite(v)]  # cost == 0 gives inf CLTV
+        if not v.size:
+            continue
+        q1, med, q3 = np.quantile(v, [0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        inside = v[(v >= q1 - 1.5 * iqr) & (v <= q3 + 1.5 * iqr)]
+        if not inside.size:
+            inside = v
+        names.append(str(ch))
+        stats.append((q1, med, q3, inside.min(), inside.max()))
+    q1, med, q3, lo, hi = np.array(stats, dtype=float).reshape(-1, 5).T.tolist()
+    fig = go.Figure(go.Box(x=names, q1=q1, median=med, q3=q3,
+                           lowerfence=lo, upperfence=hi, boxpoints=False))
+    fig.update_layout(title="CLTV Distribution by Channel", xaxis_title="channel", yaxis_title="cltv")
+    return fig
+
+# Figure cache: pre-serialized PlotData keyed by (dataset digest, builder, args);
+# gr.Plot passes PlotData through without re-encoding.
+_fig_cache = OrderedDict()
+_fig_lock = threading.Lock()
+
+def _plot(meta, build, df, *args):
+    key = (meta["_digest"], build.__name__, *args)
+    with _fig_lock:
+        if key in _fig_cache:
+            _fig_cache.move_to_end(key)
+            return _fig_cache[key]
+    fig = PlotData(type="plotly", plot=build(df, *args).to_json())
+    with _fig_lock:
+        _fig_cache[key] = fig
+        while len(_fig_cache) > FIG_CACHE_SIZE:
+            _fig_cache.popitem(last=False)
+    return fig
+
+def _overview_plots(df, meta):
+    if df is None:
+        return None, None
+    return (
+        _plot(meta, hist, df, "cost", "Distribution of Acquisition Cost"),
+        _plot(meta, hist, df, "revenue", "Distribution of Revenue"),
+    )
+
+def _channel_plots(df, by, meta):
+    if df is None or by is None:
+        return (None,) * 6
+    return (
+        _plot(meta, bar, by, "channel", "avg_cost", "Customer Acquisition Cost by Channel"),
+        _plot(meta, bar, by, "channel", "avg_conv_rate", "Conversion Rate by Channel"),
+        _plot(meta, bar, by, "channel", "avg_roi", "Return on Investment (ROI) by Channel"),
+        _plot(meta, bar, by, "channel", "avg_cltv", "Customer Lifetime Value (CLTV) by Channel"),
+        _plot(meta, pie, by), _plot(meta, cltv_box, df),
+    )
 
 # Simulator
-def simulate_reallocation(by_df: pd.DataFrame, allocations_json: str):
+def simulate_reallocation(meta: dict, allocations_json: str):
     try:
-        alloc = json.loads(allocations_json or "{}")
+        alloc = orjson.loads(allocations_json or "{}")
     except Exception:
         return "❌ Invalid JSON.", None
-    if by_df is None or by_df.empty:
+    if meta is None or not meta["_sim"]["channels"]:
         return "Load data first.", None
+    sim = meta["_sim"]
 
     # normalize to 1.0
     s = sum(alloc.values()) or 1.0
-    weights = {k: v/s for k, v in alloc.items()}
-
-    kpis = by_df.set_index("channel")[["avg_roi","avg_cltv"]]
-    for ch in kpis.index:
-        weights.setdefault(ch, 0.0)
+    channels = sim["channels"]
+    new_w = np.fromiter((alloc.get(ch, 0.0) for ch in channels), float, len(channels)) / s
 
-    new_roi  = sum(kpis.loc[ch, "avg_roi"]  * w for ch, w in weights.items())
-    new_cltv = sum(kpis.loc[ch, "avg_cltv"] * w for ch, w in weights.items())
-
-    cur_w = (by_df.set_index("channel")["revenue_share_%"] / 100.0).to_dict()
-    cur_roi  = sum(kpis.loc[ch, "avg_roi"]  * cur_w.get(ch,0) for ch in kpis.index)
-    cur_cltv = sum(kpis.loc[ch, "avg_cltv"] * cur_w.get(ch,0) for ch in kpis.index)
+    new_roi, new_cltv = float(sim["roi"] @ new_w), float(sim["cltv"] @ new_w)
+    cur_roi, cur_cltv = sim["cur_roi"], sim["cur_cltv"]
 
     delta = {
         "current_weighted_roi": round(cur_roi, 2),
@@ -116,6 +313,7 @@ with gr.Blocks(title="CLTV & ROI Dashboard", css="footer {visibility: hidden;}")
     state_df = gr.State()
     state_by = gr.State()
     state_meta = gr.State()
+    state_tab = gr.State("overview")  # plots are built only for the tab in view
 
     with gr.Row():
         file_in = gr.File(file_count="single", label="Upload CSV")
@@ -125,14 +323,14 @@ with gr.Blocks(title="CLTV & ROI Dashboard", css="footer {visibility: hidden;}")
     status = gr.Markdown()
 
     # Overview tab
-    with gr.Tab("Overview"):
+    with gr.Tab("Overview") as overview_tab:
         meta_json = gr.JSON(label="Overall Stats")
         with gr.Row():
             fig_cost_hist = gr.Plot(label="Cost Histogram")
             fig_rev_hist  = gr.Plot(label="Revenue Histogram")
 
     # Channel tab
-    with gr.Tab("Channel Analysis"):
+    with gr.Tab("Channel Analysis") as channel_tab:
         by_table = gr.Dataframe(label="Channel Summary", interactive=False, wrap=True)
         with gr.Row():
             fig_cost_ch = gr.Plot()
@@ -144,7 +342,7 @@ with gr.Blocks(title="CLTV & ROI Dashboard", css="footer {visibility: hidden;}")
         fig_cltv_boxp = gr.Plot()
 
     # Simulator tab
-    with gr.Tab("Reallocation Simulator"):
+    with gr.Tab("Reallocation Simulator") as sim_tab:
         gr.Markdown("Provide target allocation JSON (must sum ~100). "
                     "Example: `{ \"email marketing\": 20, \"paid advertising\": 10, \"referral\": 35, \"social media\": 35 }`")
         alloc_in = gr.Textbox(
@@ -156,26 +354,20 @@ with gr.Blocks(title="CLTV & ROI Dashboard", css="footer {visibility: hidden;}")
         sim_json = gr.JSON(label="Simulation Details")
 
     # Download tab
-    with gr.Tab("Download"):
+    with gr.Tab("Download") as dl_tab:
         dl1 = gr.File(label="Customer-level CSV (with metrics)", interactive=False)
         dl2 = gr.File(label="Channel summary CSV", interactive=False)
         gen_btn = gr.Button("Generate CSVs")
 
     # Callbacks
+    overview_figs = [fig_cost_hist, fig_rev_hist]
+    channel_figs = [fig_cost_ch, fig_conv_ch, fig_roi_ch, fig_cltv_ch, fig_rev_share, fig_cltv_boxp]
+
     def _render(df, by, meta, msg_prefix):
         state = (df, by, meta)
         status_text = f"{msg_prefix} • rows: {meta['rows']} • channels: {meta['channels']}"
-        return (
-            *state, status_text, meta,
-            hist(df, "cost", "Distribution of Acquisition Cost"),
-            hist(df, "revenue", "Distribution of Revenue"),
-            bar(by, "channel", "avg_cost", "Customer Acquisition Cost by Channel"),
-            bar(by, "channel", "avg_conv_rate", "Conversion Rate by Channel"),
-            bar(by, "channel", "avg_roi", "Return on Investment (ROI) by Channel"),
-            bar(by, "channel", "avg_cltv", "Customer Lifetime Value (CLTV) by Channel"),
-            pie(by), cltv_box(df),
-            by  # for table
-        )
+        stats = {k: v for k, v in meta.items() if not k.startswith("_")}
+        return (*state, status_text, stats, by)  # by for table
 
     def on_load_uploaded(file):
         df, by, meta = load_uploaded(file)
@@ -185,35 +377,60 @@ with gr.Blocks(title="CLTV & ROI Dashboard", css="footer {visibility: hidden;}")
         df, by, meta = load_builtin()
         return _render(df, by, meta, "Built-in dataset loaded")
 
-    load_btn.click(on_load_uploaded, inputs=[file_in],
-                   outputs=[state_df, state_by, state_meta, status,
-                            meta_json, fig_cost_hist, fig_rev_hist,
-                            fig_cost_ch, fig_conv_ch, fig_roi_ch, fig_cltv_ch,
-                            fig_rev_share, fig_cltv_boxp, by_table])
+    def _refresh_plots(tab, df, by, meta):
+        # Other tabs are cleared and rebuilt from the figure cache when selected.
+        ov = _overview_plots(df, meta) if tab == "overview" else (None,) * len(overview_figs)
+        ch = _channel_plots(df, by, meta) if tab == "channel" else (None,) * len(channel_figs)
+        return (*ov, *ch)
+
+    load_outputs = [state_df, state_by, state_meta, status, meta_json, by_table]
+    refresh_args = dict(fn=_refresh_plots, inputs=[state_tab, state_df, state_by, state_meta],
+                        outputs=overview_figs + channel_figs)
 
-    builtin_btn.click(on_load_builtin, inputs=[],
-                      outputs=[state_df, state_by, state_meta, status,
-                               meta_json, fig_cost_hist, fig_rev_hist,
-                               fig_cost_ch, fig_conv_ch, fig_roi_ch, fig_cltv_ch,
-                               fig_rev_share, fig_cltv_boxp, by_table])
+    load_btn.click(on_load_uploaded, inputs=[file_in], outputs=load_outputs).then(**refresh_args)
+    builtin_btn.click(on_load_builtin, inputs=[], outputs=load_outputs).then(**refresh_args)
 
-    def _simulate(alloc_json, by):
-        txt, delta = simulate_reallocation(by, alloc_json)
+    overview_tab.select(lambda df, meta: ("overview", *_overview_plots(df, meta)),
+                        inputs=[state_df, state_meta], outputs=[state_tab, *overview_figs])
+    channel_tab.select(lambda df, by, meta: ("channel", *_channel_plots(df, by, meta)),
+                       inputs=[state_df, state_by, state_meta], outputs=[state_tab, *channel_figs])
+    sim_tab.select(lambda: "simulator", inputs=[], outputs=[state_tab])
+    dl_tab.select(lambda: "download", inputs=[], outputs=[state_tab])
+
+    def _simulate(alloc_json, meta):
+        txt, delta = simulate_reallocation(meta, alloc_json)
         return txt, delta
 
-    sim_btn.click(_simulate, inputs=[alloc_in, state_by], outputs=[sim_out, sim_json])
+    sim_btn.click(_simulate, inputs=[alloc_in, state_meta], outputs=[sim_out, sim_json])
 
-    def _downloads(df, by):
-        if df is None or by is None:
+    def _downloads(df, by, meta):
+        if df is None or by is None or meta is None:
             raise gr.Error("Load data first.")
-        p1, p2 = "/tmp/customer_with_metrics.csv", "/tmp/channel_summary.csv"
-        pd.DataFrame(df).to_csv(p1, index=False)
-        pd.DataFrame(by).to_csv(p2, index=False)
+        # Files are named by dataset digest, so an existing file is already up to date
+        digest = meta["_digest"]
+        p1 = f"/tmp/customer_with_metrics.{digest}.csv"
+        p2 = f"/tmp/channel_summary.{digest}.csv"
+        for frame, prefix, path in ((df, "customer_with_metrics", p1), (by, "channel_summary", p2)):
+            try:
+                os.utime(path)  # mark as recently used so pruning keeps it
+                continue
+            except FileNotFoundError:  # never written, or just pruned: write it
+                pass
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            _write_csv(frame, tmp)
+            os.replace(tmp, path)
+            _prune_downloads(prefix)
         return p1, p2
 
-    gen_btn.click(_downloads, inputs=[state_df, state_by], outputs=[dl1, dl2])
+    gen_btn.click(_downloads, inputs=[state_df, state_by, state_meta], outputs=[dl1, dl2])
 
 # Auto-load built-in on startup in Spaces
 if __name__ == "__main__":
     # If running locally: open and load default dataset
-    demo.queue().launch()
+    # Warm the dataset and Overview figure caches so the first click is served from memory
+    try:
+        df, by, meta = load_builtin()
+        _overview_plots(df, meta)
+    except Exception:
+        pass  # best effort: the same error is reported when the user clicks load
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY, max_size=QUEUE_MAX_SIZE).launch()